@@ -1,80 +1,638 @@
 from flask import Flask, request, jsonify
+import asyncio
+import numpy as np
 import pandas as pd
+import hashlib
+import httpx
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
 import requests
+import shelve
+import tempfile
+import threading
+import time
+from cachetools import TTLCache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from io import BytesIO
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from openpyxl import load_workbook
+
+# Optional: Rust-backed Excel parser, much faster than the pure-Python engines
+try:
+    import python_calamine  # noqa: F401
+    PANDAS_EXCEL_ENGINE = 'calamine'
+except ImportError:
+    PANDAS_EXCEL_ENGINE = None
+
+# Optional: sentence embeddings for the semantic /explain cache
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Optional: columnar cache of parsed files (order-of-magnitude faster re-reads)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Optional: compiled single-pass reduction kernel for the pandas path
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Optional: faster JSON serialization for the request-critical ACK path
+try:
+    import orjson
+    from flask.json.provider import JSONProvider
+
+    class OrjsonProvider(JSONProvider):
+        """Flask JSON provider backed by orjson"""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+except ImportError:
+    OrjsonProvider = None
+
+# Optional: token counting for prompt-size logging
+try:
+    import tiktoken
+    _token_encoder = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _token_encoder = None
 
 app = Flask(__name__)
 
+# Route all jsonify/request.json traffic through orjson when available
+if OrjsonProvider is not None:
+    app.json = OrjsonProvider(app)
+
+# Queued logging: the stream handler runs on a listener thread, so request
+# handlers never block on a stdout flush during bursts
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+
+log = logging.getLogger('actuarial')
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(logging.INFO)
+
 # ============================================
 # CONFIGURATION - Uses Environment Variables
 # ============================================
 EXCEL_FILE = 'actuarial_sophisticated_sample.xlsx'
 LOSS_RATIO_THRESHOLD = 75.0
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # refuse uploads larger than 20 MB
 
 # Read from environment variables (set in Render dashboard)
 SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN', 'YOUR_SLACK_BOT_TOKEN_HERE')
 DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', 'YOUR_DEEPSEEK_API_KEY_HERE')
 # ============================================
 
-# Track the most recently uploaded file and analysis
-LAST_UPLOADED_FILE = None
-LAST_UPLOADED_FILE_NAME = None
-LAST_ANALYSIS_RESULT = None
+# Track the most recently uploaded file and analysis *per channel*,
+# bounded and expiring so concurrent channels can't clobber each other
+_state = TTLCache(maxsize=1024, ttl=3600)
+_state_lock = threading.RLock()
+
+
+def get_state(key):
+    """Return the stored state dict for a channel, or None"""
+    with _state_lock:
+        return _state.get(key)
+
+
+def put_state(key, file_url=None, file_name=None, file_id=None, result=None):
+    """Update a channel's state, keeping fields that aren't being set"""
+    if key is None:
+        return
+    with _state_lock:
+        state = dict(_state.get(key) or {})
+        if file_url is not None:
+            state['file_url'] = file_url
+        if file_name is not None:
+            state['file_name'] = file_name
+        if file_id is not None:
+            state['file_id'] = file_id
+        if result is not None:
+            state['result'] = result
+        _state[key] = state
+
+# Cache of computed results so repeat /lossratio and /explain calls
+# don't re-download and re-parse the same Excel file.
+# Keyed by content hash (for Slack downloads) or (path, mtime) for local files.
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_MAX = 32
+_result_cache_lock = threading.Lock()
 
-# Initialize DeepSeek client
+
+def _cache_get(key):
+    """Look up a cached analysis result, refreshing its LRU position"""
+    with _result_cache_lock:
+        result = _RESULT_CACHE.get(key)
+        if result is not None:
+            _RESULT_CACHE.move_to_end(key)
+        return result
+
+
+def _cache_put(key, result):
+    """Store an analysis result, evicting the oldest entry if full"""
+    with _result_cache_lock:
+        _RESULT_CACHE[key] = result
+        _RESULT_CACHE.move_to_end(key)
+        if len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+            _RESULT_CACHE.popitem(last=False)
+
+# Reused HTTP session for Slack file downloads; keeping connections warm
+# avoids a fresh TLS handshake to files.slack.com on every upload
+_http = requests.Session()
+_http.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Initialize DeepSeek client (with connection keep-alive to api.deepseek.com)
 deepseek_client = OpenAI(
     api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com"
+    base_url="https://api.deepseek.com",
+    http_client=httpx.Client(limits=httpx.Limits(max_keepalive_connections=8))
+)
+
+# Async twin of the DeepSeek client, used for streamed /explain answers
+deepseek_async_client = AsyncOpenAI(
+    api_key=DEEPSEEK_API_KEY,
+    base_url="https://api.deepseek.com",
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=8))
 )
 
-def calculate_loss_ratio(file_source=None):
+# ============================================
+# DEEPSEEK COMPLETION CACHE
+# ============================================
+# Tier 1: exact match on the prompt hash, persisted to disk via shelve
+# Tier 2: semantic match on /explain question embeddings (optional)
+COMPLETION_CACHE_PATH = os.environ.get('COMPLETION_CACHE_PATH', '/tmp/deepseek_completions')
+SEMANTIC_SIMILARITY_THRESHOLD = 0.9
+
+_completion_cache_lock = threading.Lock()
+
+# In-memory rows of (embedding, context_key, answer) for semantic lookup
+_semantic_rows = []
+_embedder = None
+
+
+# Static prompt scaffolding lives in the system message, built once.
+# Keeping it byte-identical across requests also lets the provider
+# reuse its cached prompt prefix.
+INSIGHT_SYSTEM = """You are an expert actuary analyzing insurance portfolio data.
+
+Given analysis results, provide a brief, professional 2-3 sentence insight about:
+1. What this loss ratio indicates about portfolio health
+2. Whether it's above/below threshold and what that means
+3. One actionable recommendation
+
+Keep it concise and business-focused."""
+
+EXPLAIN_SYSTEM = """You are an expert actuary. A user is asking about their portfolio analysis.
+
+Provide a clear, professional answer based on the analysis context given. Be specific and reference the actual numbers. Keep it under 4 sentences."""
+
+
+@lru_cache(maxsize=8)
+def _system_msg(system):
+    """Reusable system-message dict; built once per prompt constant"""
+    return {"role": "system", "content": system}
+
+
+@lru_cache(maxsize=512)
+def _count_tokens(text):
+    """Token count for a prompt string, memoized (repeat prompts are common)"""
+    if _token_encoder is None:
+        return len(text) // 4  # rough heuristic when tiktoken is absent
+    return len(_token_encoder.encode(text))
+
+
+def _format_metrics(result):
+    """The five variable metric lines shared by both AI prompts"""
+    return (
+        f"- Total Premium: ${result['premium']:,.0f}\n"
+        f"- Total Claims: ${result['claims']:,.0f}\n"
+        f"- Loss Ratio: {result['loss_ratio']:.1f}%\n"
+        f"- Number of Policies: {result['num_policies']}\n"
+        f"- Risk Threshold: {LOSS_RATIO_THRESHOLD}%"
+    )
+
+
+def _get_embedder():
+    """Lazily load the sentence-transformer model (heavy import)"""
+    global _embedder
+    if _embedder is None and SentenceTransformer is not None:
+        _embedder = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+    return _embedder
+
+
+# Insights already generated for a context (the upload flow produces one
+# right away), reused by /explain so DeepSeek doesn't re-derive the
+# portfolio framing on every question
+_insight_cache = TTLCache(maxsize=256, ttl=3600)
+_insight_cache_lock = threading.Lock()
+
+
+def _remember_insight(result, insight):
+    """Keep a generated insight keyed by its analysis context"""
+    if insight:
+        with _insight_cache_lock:
+            _insight_cache[_context_key(result)] = insight
+
+
+def _recall_insight(result):
+    """The insight previously generated for this context, or None"""
+    with _insight_cache_lock:
+        return _insight_cache.get(_context_key(result))
+
+
+def _explain_messages(context_result, question):
+    """
+    Build the /explain conversation. When an insight was already
+    generated for this context, it rides along as an assistant turn so
+    the model starts from the established framing instead of re-deriving it.
+    """
+    insight = _recall_insight(context_result)
+    if insight:
+        return [
+            _system_msg(EXPLAIN_SYSTEM),
+            {"role": "user", "content": f"Analysis Results:\n{_format_metrics(context_result)}"},
+            {"role": "assistant", "content": insight},
+            {"role": "user", "content": question}
+        ]
+    prompt = f"Current Analysis Context:\n{_format_metrics(context_result)}\n\nUser Question: {question}"
+    return [_system_msg(EXPLAIN_SYSTEM), {"role": "user", "content": prompt}]
+
+
+def _prompt_key(system, user):
+    """Exact-match cache key for a (system, user) prompt pair"""
+    return hashlib.sha256(f'{system}\x00{user}'.encode('utf-8')).hexdigest()
+
+
+def _messages_key(messages):
+    """Exact-match cache key for a full message list"""
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _completion_cache_get(key):
+    """Look up a stored completion, or None"""
+    with _completion_cache_lock:
+        with shelve.open(COMPLETION_CACHE_PATH) as db:
+            return db.get(key)
+
+
+def _completion_cache_put(key, completion):
+    """Persist a completion for future exact-match hits"""
+    with _completion_cache_lock:
+        with shelve.open(COMPLETION_CACHE_PATH) as db:
+            db[key] = completion
+
+
+def cached_complete(system, user, temperature=0.7, max_tokens=200):
+    """
+    Call DeepSeek with an exact-match cache on the prompt.
+    Identical (system, user) pairs return the stored completion
+    without a network round-trip.
+    """
+    key = _prompt_key(system, user)
+
+    completion = _completion_cache_get(key)
+    if completion is not None:
+        log.info("⚡ Using cached completion")
+        return completion
+
+    log.info(f"📤 Sending ~{_count_tokens(system) + _count_tokens(user)} prompt tokens")
+    response = deepseek_client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[
+            _system_msg(system),
+            {"role": "user", "content": user}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+    completion = response.choices[0].message.content.strip()
+
+    _completion_cache_put(key, completion)
+
+    return completion
+
+
+def _context_key(result):
+    """Stable key for an analysis context, rounded to display precision"""
+    return (
+        round(result['premium']),
+        round(result['claims']),
+        round(result['loss_ratio'], 1),
+        result['num_policies']
+    )
+
+
+def _semantic_lookup(question, context_key):
+    """
+    Find a cached answer to a similar question asked about the *same*
+    analysis context. Returns None on miss or if embeddings are unavailable.
+    """
+    embedder = _get_embedder()
+    if embedder is None:
+        return None
+
+    embedding = embedder.encode(question)
+    best_answer = None
+    best_similarity = SEMANTIC_SIMILARITY_THRESHOLD
+
+    with _completion_cache_lock:
+        for row_embedding, row_context, row_answer in _semantic_rows:
+            # Only match answers generated for this exact context,
+            # so a similar question about different numbers never hits
+            if row_context != context_key:
+                continue
+            norm = (embedding @ embedding) ** 0.5 * (row_embedding @ row_embedding) ** 0.5
+            similarity = float(embedding @ row_embedding) / norm if norm > 0 else 0.0
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best_answer = row_answer
+
+    if best_answer:
+        log.info(f"⚡ Semantic cache hit (similarity {best_similarity:.2f})")
+    return best_answer
+
+
+def _semantic_store(question, context_key, answer):
+    """Remember a generated answer for future similar questions"""
+    embedder = _get_embedder()
+    if embedder is None:
+        return
+    embedding = embedder.encode(question)
+    with _completion_cache_lock:
+        _semantic_rows.append((embedding, context_key, answer))
+
+def _read_excel(source):
+    """
+    Read an Excel file into a DataFrame, using the calamine engine
+    when python-calamine is installed (falls back to pandas' default)
+    """
+    if PANDAS_EXCEL_ENGINE:
+        return pd.read_excel(source, engine=PANDAS_EXCEL_ENGINE)
+    return pd.read_excel(source)
+
+# On-disk columnar cache of already-parsed files, keyed by Slack file id.
+# Unlike the in-memory result cache it survives restarts, and Parquet
+# decode is an order of magnitude faster than re-parsing xlsx.
+PARQUET_CACHE_DIR = os.environ.get('PARQUET_CACHE_DIR', '/tmp/xlsx_cache')
+
+# Columns every analyzed file must contain
+_REQUIRED = frozenset({'Premium', 'Claims'})
+
+
+def _missing_columns_error(missing):
+    return {
+        'success': False,
+        'error': f'Missing required columns: {", ".join(sorted(missing))}. File must have "Premium" and "Claims" columns.'
+    }
+
+
+def _parquet_path(file_id):
+    return os.path.join(PARQUET_CACHE_DIR, f'{file_id}.parquet')
+
+
+def _write_parquet_cache(path, premiums, claims):
+    """Persist the two analyzed columns for fast future re-reads"""
+    if pa is None:
+        return
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, exist_ok=True)
+        table = pa.table({
+            'Premium': pa.array(premiums, type=pa.float64()),
+            'Claims': pa.array(claims, type=pa.float64())
+        })
+        pq.write_table(table, path, compression='zstd')
+    except Exception as e:
+        log.warning(f"⚠️ Could not write Parquet cache: {e}")
+
+
+def _read_parquet_cache(path):
+    """Summarize a previously cached Parquet file, or None on miss"""
+    if pq is None or not os.path.exists(path):
+        return None
+    try:
+        df = pq.read_table(path, columns=['Premium', 'Claims']).to_pandas()
+        return _summarize(df)
+    except Exception as e:
+        log.warning(f"⚠️ Could not read Parquet cache: {e}")
+        return None
+
+
+def _sum_premium_claims(source, parquet_path=None):
+    """
+    Stream an .xlsx file in openpyxl read-only mode and accumulate the
+    Premium/Claims totals row by row, without building a DataFrame.
+    Args:
+        source: a file path or binary stream of an .xlsx file
+        parquet_path: if given, the two columns are also persisted there
+    Returns: same dict shape as _summarize
+    """
+    collect = parquet_path is not None and pa is not None
+    premiums = []
+    claims = []
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+
+        # Locate the Premium/Claims columns from the header row
+        header = next(sheet.iter_rows(max_row=1, values_only=True), None) or ()
+        missing_columns = _REQUIRED.difference(header)
+        if missing_columns:
+            return _missing_columns_error(missing_columns)
+        premium_idx = header.index('Premium')
+        claims_idx = header.index('Claims')
+
+        # Single pass over the data rows
+        total_premium = 0.0
+        total_claims = 0.0
+        num_policies = 0
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            # Read-only sheets can report trailing empty rows
+            if all(value is None for value in row):
+                continue
+            premium = row[premium_idx] or 0
+            claim = row[claims_idx] or 0
+            total_premium += premium
+            total_claims += claim
+            num_policies += 1
+            if collect:
+                premiums.append(premium)
+                claims.append(claim)
+    finally:
+        workbook.close()
+
+    if collect:
+        _write_parquet_cache(parquet_path, premiums, claims)
+
+    loss_ratio = (total_claims / total_premium) * 100 if total_premium > 0 else 0
+
+    return {
+        'success': True,
+        'premium': total_premium,
+        'claims': total_claims,
+        'loss_ratio': loss_ratio,
+        'num_policies': num_policies
+    }
+
+if njit is not None:
+    # Compiled once per deploy (cache=True persists the machine code),
+    # and the natural place to add per-row diagnostics later without
+    # paying Python-loop overhead
+    @njit(cache=True, fastmath=True)
+    def _reduce(premiums, claims):
+        total_premium = 0.0
+        total_claims = 0.0
+        n = premiums.shape[0]
+        for i in range(n):
+            total_premium += premiums[i]
+            total_claims += claims[i]
+        return total_premium, total_claims, n
+else:
+    def _reduce(premiums, claims):
+        """NumPy fallback when numba isn't installed"""
+        return float(premiums.sum()), float(claims.sum()), premiums.shape[0]
+
+def _summarize(df):
+    """
+    Reduce a parsed DataFrame to the loss ratio result dict
+    """
+    # Validate required columns exist (single C-level set difference)
+    missing_columns = _REQUIRED.difference(df.columns)
+    if missing_columns:
+        return _missing_columns_error(missing_columns)
+
+    # Calculate totals in a single compiled pass over both columns.
+    # Blank cells parse as NaN; zero them first to keep Series.sum's
+    # skipna semantics (the streaming path coerces None → 0 the same way)
+    arr = np.nan_to_num(df[['Premium', 'Claims']].to_numpy(dtype=np.float64, copy=False))
+    total_premium, total_claims, num_policies = _reduce(
+        np.ascontiguousarray(arr[:, 0]), np.ascontiguousarray(arr[:, 1])
+    )
+
+    # Calculate loss ratio
+    loss_ratio = (total_claims / total_premium) * 100 if total_premium > 0 else 0
+
+    return {
+        'success': True,
+        'premium': total_premium,
+        'claims': total_claims,
+        'loss_ratio': loss_ratio,
+        'num_policies': num_policies
+    }
+
+# Worker processes for Excel parsing: openpyxl's XML parse is pure-Python
+# CPU work that holds the GIL, so threads alone can't parse in parallel.
+# Spawn (not fork): the pool starts lazily once the logging listener,
+# event-loop and event-pool threads are live, and forking with live
+# threads can deadlock a child on a copied lock
+_parse_pool = ProcessPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1),
+    mp_context=multiprocessing.get_context('spawn')
+)
+
+def _parse_excel_bytes(content, parquet_path=None):
+    """
+    Parse Excel file bytes into the analysis result dict.
+    Takes plain bytes and returns a plain dict so it can run in a
+    worker process. When parquet_path is given, the parsed columns are
+    persisted there for fast re-reads.
+    """
+    # .xlsx files start with the zip magic; stream those through
+    # openpyxl, fall back to pandas for legacy .xls
+    if content[:4] == b'PK\x03\x04':
+        return _sum_premium_claims(BytesIO(content), parquet_path=parquet_path)
+    df = _read_excel(BytesIO(content))
+    if parquet_path is not None and pa is not None and _REQUIRED.issubset(df.columns):
+        _write_parquet_cache(parquet_path, df['Premium'].tolist(), df['Claims'].tolist())
+    return _summarize(df)
+
+def calculate_loss_ratio(file_source=None, file_id=None):
     """
     Read Excel file and calculate actuarial loss ratio
     Args:
         file_source: Either a file path (str) or file URL (str) or None (uses default)
+        file_id: Slack file id, used to key the on-disk Parquet cache
     Returns: dict with premium, claims, and loss ratio
     """
     try:
         # Read Excel file from different sources
         if file_source and file_source.startswith('http'):
-            # Download file from URL (for Slack file uploads)
+            # A previously parsed file can be summarized straight from
+            # its Parquet cache, skipping the download entirely
+            parquet_path = _parquet_path(file_id) if file_id else None
+            if parquet_path:
+                cached = _read_parquet_cache(parquet_path)
+                if cached is not None:
+                    log.info("⚡ Using Parquet cache")
+                    return cached
+
+            # Download file from URL (for Slack file uploads), streaming
+            # chunks into a spooled temp file (spills to disk past 8 MB)
+            # instead of buffering the whole body in RAM first
             headers = {'Authorization': f'Bearer {SLACK_BOT_TOKEN}'}
-            response = requests.get(file_source, headers=headers)
-            response.raise_for_status()
-            df = pd.read_excel(BytesIO(response.content))
-        elif file_source:
-            # Read from local file path
-            df = pd.read_excel(file_source)
+            with _http.get(file_source, headers=headers, stream=True, timeout=(3, 60)) as response:
+                response.raise_for_status()
+                digest = hashlib.sha256()
+                with tempfile.SpooledTemporaryFile(max_size=8 << 20) as tmp:
+                    # Hash the chunks as they arrive for the result cache key
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+
+                    # Skip the Excel parse entirely if we've seen this content
+                    cache_key = ('sha256', digest.hexdigest())
+                    cached = _cache_get(cache_key)
+                    if cached is not None:
+                        log.info("⚡ Using cached analysis result")
+                        return cached
+
+                    # Hand the bytes to a worker process so concurrent
+                    # uploads parse on separate cores (bounded by the
+                    # 20 MB upload cap)
+                    tmp.seek(0)
+                    content = tmp.read()
+                    try:
+                        result = _parse_pool.submit(_parse_excel_bytes, content, parquet_path).result(timeout=30)
+                    except (BrokenProcessPool, FutureTimeoutError) as pool_error:
+                        log.warning(f"⚠️ Parse pool unavailable ({pool_error}), parsing in-process")
+                        result = _parse_excel_bytes(content, parquet_path)
         else:
-            # Use default file
-            df = pd.read_excel(EXCEL_FILE)
-        
-        # Validate required columns exist
-        required_columns = ['Premium', 'Claims']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            return {
-                'success': False, 
-                'error': f'Missing required columns: {", ".join(missing_columns)}. File must have "Premium" and "Claims" columns.'
-            }
-        
-        # Calculate totals
-        total_premium = df['Premium'].sum()
-        total_claims = df['Claims'].sum()
-        
-        # Calculate loss ratio
-        loss_ratio = (total_claims / total_premium) * 100 if total_premium > 0 else 0
-        
-        return {
-            'success': True,
-            'premium': total_premium,
-            'claims': total_claims,
-            'loss_ratio': loss_ratio,
-            'num_policies': len(df)
-        }
-    
+            # Read from local file path (or the default file)
+            path = file_source or EXCEL_FILE
+            cache_key = ('path', path, os.path.getmtime(path))
+            cached = _cache_get(cache_key)
+            if cached is not None:
+                log.info("⚡ Using cached analysis result")
+                return cached
+
+            if path.endswith('.xlsx'):
+                result = _sum_premium_claims(path)
+            else:
+                result = _summarize(_read_excel(path))
+
+        # Cache the reduced result (deterministic for a given file content)
+        _cache_put(cache_key, result)
+        return result
+
     except FileNotFoundError:
         return {'success': False, 'error': 'Excel file not found'}
     except KeyError as e:
@@ -84,131 +642,132 @@ def calculate_loss_ratio(file_source=None):
     except Exception as e:
         return {'success': False, 'error': f'Error reading file: {str(e)}'}
 
+# Pre-written insights for the unambiguous bands; only borderline ratios
+# (where interpretation genuinely varies) are worth a DeepSeek call
+_CANNED_INSIGHTS = {
+    'no_premium': (
+        "No earned premium was recorded, so the loss ratio cannot be interpreted meaningfully. "
+        "Verify the Premium column is populated before drawing any conclusions from this file."
+    ),
+    'zero': (
+        "No claims have been recorded against this portfolio, giving a 0% loss ratio. "
+        "Confirm the Claims data is complete before treating this as genuine underwriting performance."
+    ),
+    'healthy': (
+        "At {loss_ratio:.1f}%, the loss ratio sits comfortably below the {threshold:.0f}% threshold, indicating a profitable, well-priced portfolio. "
+        "Maintain current underwriting standards and monitor for claims-trend deterioration."
+    ),
+    'elevated': (
+        "At {loss_ratio:.1f}%, the loss ratio is clearly above the {threshold:.0f}% threshold, signalling that claims are eroding underwriting margin. "
+        "Review pricing adequacy and loss drivers in the worst-performing segments."
+    ),
+    'critical': (
+        "At {loss_ratio:.1f}%, the loss ratio is far above the {threshold:.0f}% threshold and the portfolio is paying out substantially more than it earns. "
+        "Immediate corrective action is warranted: re-rate or restrict the worst segments and investigate large or systemic claims."
+    ),
+}
+
+
+def _classify(loss_ratio, threshold):
+    """Bucket a loss ratio into an insight band around the threshold"""
+    if loss_ratio == 0:
+        return 'zero'
+    if loss_ratio < threshold - 5:
+        return 'healthy'
+    if loss_ratio <= threshold + 10:
+        return 'borderline'
+    if loss_ratio <= threshold + 40:
+        return 'elevated'
+    return 'critical'
+
+
 def generate_ai_insights(result):
     """
     Generate AI-powered insights about the loss ratio analysis
     """
     if not result['success']:
         return None
-    
-    try:
-        # Create prompt for DeepSeek
-        prompt = f"""You are an expert actuary analyzing insurance portfolio data.
-
-Analysis Results:
-- Total Premium: ${result['premium']:,.0f}
-- Total Claims: ${result['claims']:,.0f}
-- Loss Ratio: {result['loss_ratio']:.1f}%
-- Number of Policies: {result['num_policies']}
-- Risk Threshold: {LOSS_RATIO_THRESHOLD}%
 
-Provide a brief, professional 2-3 sentence insight about:
-1. What this loss ratio indicates about portfolio health
-2. Whether it's above/below threshold and what that means
-3. One actionable recommendation
+    try:
+        # Deterministic cases short-circuit without an LLM round-trip
+        if result['premium'] <= 0:
+            band = 'no_premium'
+        else:
+            band = _classify(result['loss_ratio'], LOSS_RATIO_THRESHOLD)
+        canned = _CANNED_INSIGHTS.get(band)
+        if canned:
+            log.info(f"⚡ Deterministic insight band: {band}")
+            insight = canned.format(loss_ratio=result['loss_ratio'], threshold=LOSS_RATIO_THRESHOLD)
+            _remember_insight(result, insight)
+            return insight
 
-Keep it concise and business-focused."""
+        # Only the variable metric lines go in the user message
+        prompt = f"Analysis Results:\n{_format_metrics(result)}"
 
-        # Call DeepSeek API
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "You are an expert actuarial analyst providing concise, actionable insights."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=200
-        )
-        
-        insight = response.choices[0].message.content.strip()
+        # Call DeepSeek API (exact-match cached: the prompt is fully
+        # determined by the rounded metrics above)
+        insight = cached_complete(INSIGHT_SYSTEM, prompt, max_tokens=200)
+        _remember_insight(result, insight)
         return insight
-    
+
     except Exception as e:
-        print(f"❌ AI insight generation failed: {e}")
+        log.error(f"❌ AI insight generation failed: {e}")
         return None
 
-def answer_actuarial_question(question, context_result):
-    """
-    Use AI to answer questions about the actuarial analysis
-    """
-    if not context_result or not context_result.get('success'):
-        return "I don't have any analysis data to reference. Please upload an Excel file or run /lossratio first."
-    
-    try:
-        # Create context-aware prompt
-        prompt = f"""You are an expert actuary. A user is asking about their portfolio analysis.
-
-Current Analysis Context:
-- Total Premium: ${context_result['premium']:,.0f}
-- Total Claims: ${context_result['claims']:,.0f}
-- Loss Ratio: {context_result['loss_ratio']:.1f}%
-- Number of Policies: {context_result['num_policies']}
-- Risk Threshold: {LOSS_RATIO_THRESHOLD}%
-
-User Question: {question}
-
-Provide a clear, professional answer based on the analysis data above. Be specific and reference the actual numbers. Keep it under 4 sentences."""
-
-        # Call DeepSeek API
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "You are an expert actuarial consultant providing clear, data-driven answers."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=300
-        )
-        
-        answer = response.choices[0].message.content.strip()
-        return answer
-    
-    except Exception as e:
-        print(f"❌ AI answer generation failed: {e}")
-        return f"Sorry, I couldn't generate an answer. Error: {str(e)}"
+def _mrkdwn_section(text):
+    """A single Block Kit mrkdwn section"""
+    return {'type': 'section', 'text': {'type': 'mrkdwn', 'text': text}}
 
-def format_slack_response(result, file_name=None, include_ai=True):
+def _build_blocks(result, file_name=None):
     """
-    Format the calculation results for Slack with optional AI insights
+    Build the Block Kit blocks for an analysis result (or its error)
     """
     if not result['success']:
         file_info = f" ({file_name})" if file_name else ""
-        return {
-            'response_type': 'in_channel',
-            'text': f"❌ *Error{file_info}:* {result['error']}"
-        }
-    
+        return [_mrkdwn_section(f"❌ *Error{file_info}:* {result['error']}")]
+
     # Check if loss ratio exceeds threshold
     warning = ""
     if result['loss_ratio'] > LOSS_RATIO_THRESHOLD:
         warning = f"\n⚠️ *Warning:* Loss ratio exceeds {LOSS_RATIO_THRESHOLD}% threshold!"
-    
-    # Format currency
+
+    # Format currency once
     premium_formatted = f"${result['premium']:,.0f}"
     claims_formatted = f"${result['claims']:,.0f}"
-    
+
     # Add file name if provided
     file_header = f"📄 *Analysis of: {file_name}*\n\n" if file_name else ""
-    
-    # Create basic message
-    message = f"""{file_header}📊 *Actuarial Loss Ratio Analysis*
+
+    return [_mrkdwn_section(f"""{file_header}📊 *Actuarial Loss Ratio Analysis*
 
 *Premium:* {premium_formatted}
 *Claims:* {claims_formatted}
 *Loss Ratio:* {result['loss_ratio']:.1f}%
-*Policies Analyzed:* {result['num_policies']}{warning}
-"""
-    
-    # Add AI insights if enabled
-    if include_ai and DEEPSEEK_API_KEY != 'YOUR_DEEPSEEK_API_KEY_HERE':
-        print("🤖 Generating AI insights...")
-        ai_insight = generate_ai_insights(result)
-        if ai_insight:
-            message += f"\n🤖 *AI Insights:*\n_{ai_insight}_"
-    
+*Policies Analyzed:* {result['num_policies']}{warning}""")]
+
+def format_slack_response(result, file_name=None, include_ai=True):
+    """
+    Format the calculation results as Block Kit, with optional AI insights
+    and a plain-text fallback for notifications
+    """
+    blocks = _build_blocks(result, file_name)
+
+    if not result['success']:
+        fallback = f"❌ Error: {result['error']}"
+    else:
+        fallback = f"📊 Loss Ratio: {result['loss_ratio']:.1f}% ({result['num_policies']} policies)"
+
+        # Add AI insights if enabled
+        if include_ai and DEEPSEEK_API_KEY != 'YOUR_DEEPSEEK_API_KEY_HERE':
+            log.info("🤖 Generating AI insights...")
+            ai_insight = generate_ai_insights(result)
+            if ai_insight:
+                blocks.append(_mrkdwn_section(f"🤖 *AI Insights:*\n_{ai_insight}_"))
+
     return {
         'response_type': 'in_channel',
-        'text': message
+        'text': fallback,
+        'blocks': blocks
     }
 
 def send_message_to_channel(channel_id, result, file_name=None, include_ai=True):
@@ -217,101 +776,219 @@ def send_message_to_channel(channel_id, result, file_name=None, include_ai=True)
     """
     try:
         from slack_sdk import WebClient
-        
+
         client = WebClient(token=SLACK_BOT_TOKEN)
-        
+
         # Format the message
         response = format_slack_response(result, file_name, include_ai)
-        
-        # Send to channel
-        client.chat_postMessage(channel=channel_id, text=response['text'])
-        print(f"✅ Sent analysis to channel {channel_id}")
+
+        # Send to channel (blocks render; text is the notification fallback)
+        client.chat_postMessage(channel=channel_id, text=response['text'], blocks=response['blocks'])
+        log.info(f"✅ Sent analysis to channel {channel_id}")
+    except Exception as e:
+        log.error(f"❌ Error sending message: {e}")
+
+# Bounded worker pool so file analysis runs off the request thread
+_event_pool = ThreadPoolExecutor(max_workers=4)
+
+# Persistent event loop on a daemon thread for async Slack/DeepSeek fan-out,
+# so /explain doesn't pay thread-creation (or loop-creation) cost per call
+_async_loop = asyncio.new_event_loop()
+threading.Thread(target=_async_loop.run_forever, daemon=True).start()
+
+# How often the streamed answer is flushed into the Slack message
+_STREAM_UPDATE_SECONDS = 0.4
+_STREAM_UPDATE_CHARS = 60
+
+async def _stream_answer(question, context_result, client, channel_id, ts):
+    """
+    Generate the answer with DeepSeek streaming, editing the placeholder
+    message as text accumulates. Cache hits return the full answer at once.
+    """
+    context_key = _context_key(context_result)
+
+    # A similar question already answered for this exact context?
+    cached = await asyncio.to_thread(_semantic_lookup, question, context_key)
+    if cached:
+        return cached
+
+    # Build the conversation, reusing any prewarmed insight
+    messages = _explain_messages(context_result, question)
+    key = _messages_key(messages)
+    cached = await asyncio.to_thread(_completion_cache_get, key)
+    if cached:
+        log.info("⚡ Using cached completion")
+        return cached
+
+    # Stream tokens; no max_tokens cap, the prompt already bounds length
+    log.info(f"📤 Sending ~{sum(_count_tokens(m['content']) for m in messages)} prompt tokens")
+    stream = await deepseek_async_client.chat.completions.create(
+        model="deepseek-chat",
+        messages=messages,
+        temperature=0.7,
+        stream=True
+    )
+
+    buffer = ""
+    flushed_len = 0
+    last_flush = time.monotonic()
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        buffer += chunk.choices[0].delta.content or ""
+        now = time.monotonic()
+        if len(buffer) - flushed_len >= _STREAM_UPDATE_CHARS and now - last_flush >= _STREAM_UPDATE_SECONDS:
+            await client.chat_update(channel=channel_id, ts=ts, text=f"🤖 *AI Answer:*\n{buffer} ▌")
+            flushed_len = len(buffer)
+            last_flush = now
+
+    answer = buffer.strip()
+
+    # Store in both cache tiers for next time
+    await asyncio.to_thread(_completion_cache_put, key, answer)
+    await asyncio.to_thread(_semantic_store, question, context_key, answer)
+    return answer
+
+async def _generate_and_post_answer(question, context_result, channel_id):
+    """
+    Generate the AI answer and stream it into a channel message,
+    so the first tokens show up without waiting for the full completion.
+    """
+    client = None
+    ts = None
+    try:
+        from slack_sdk.web.async_client import AsyncWebClient
+
+        client = AsyncWebClient(token=SLACK_BOT_TOKEN)
+
+        log.info(f"🤖 Generating answer for: {question}")
+
+        # Post the placeholder; its ts is what the stream keeps editing
+        posted = await client.chat_postMessage(channel=channel_id, text="🤖 _Generating answer..._")
+        ts = posted['ts']
+
+        answer = await _stream_answer(question, context_result, client, channel_id, ts)
+
+        # Final edit flushes whatever the periodic updates didn't
+        await client.chat_update(channel=channel_id, ts=ts, text=f"🤖 *AI Answer:*\n{answer}")
+        log.info("✅ Posted AI answer to channel")
     except Exception as e:
-        print(f"❌ Error sending message: {e}")
+        log.error(f"❌ Error posting answer: {e}")
+
+        # Don't leave the placeholder stuck on "Generating answer..."
+        if client is not None:
+            error_text = f"Sorry, I couldn't generate an answer. Error: {str(e)}"
+            try:
+                if ts:
+                    await client.chat_update(channel=channel_id, ts=ts, text=error_text)
+                else:
+                    await client.chat_postMessage(channel=channel_id, text=error_text)
+            except Exception as post_error:
+                log.error(f"❌ Could not report the error to the channel: {post_error}")
+
+def _handle_file_event(event):
+    """
+    Download, analyze and respond to an uploaded file.
+    Runs on a worker thread, after the event has already been ACKed.
+    """
+    channel = event['channel']
+
+    # Get the first uploaded file
+    file_info = event['files'][0]
+    file_url = file_info.get('url_private')
+    file_name = file_info.get('name', 'unknown')
+    file_type = file_info.get('filetype', '')
+    file_size = file_info.get('size', 0)
+
+    log.info(f"📎 File uploaded: {file_name}")
+
+    # Validate from Slack's file metadata before downloading anything:
+    # the filetype field is more reliable than the filename suffix, and
+    # the size cap keeps oversized uploads off the parse path entirely
+    if file_type not in ('xlsx', 'xls'):
+        log.warning(f"⚠️ File is not Excel: {file_name}")
+        error_result = {
+            'success': False,
+            'error': f'Please upload an Excel file (.xlsx or .xls). You uploaded: {file_name}'
+        }
+        send_message_to_channel(event['channel'], error_result, include_ai=False)
+    elif file_size > MAX_UPLOAD_BYTES:
+        log.warning(f"⚠️ File too large: {file_name} ({file_size} bytes)")
+        error_result = {
+            'success': False,
+            'error': f'File is too large ({file_size / (1024 * 1024):.1f} MB). Maximum supported size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.'
+        }
+        send_message_to_channel(event['channel'], error_result, include_ai=False)
+    else:
+        # Save as the channel's last uploaded file
+        file_id = file_info.get('id')
+        put_state(channel, file_url=file_url, file_name=file_name, file_id=file_id)
+        log.info(f"💾 Saved as last uploaded file: {file_name}")
+
+        # Analyze the uploaded file
+        log.info(f"🔍 Analyzing {file_name}...")
+        result = calculate_loss_ratio(file_url, file_id=file_id)
+
+        # Save the analysis for /explain command
+        put_state(channel, result=result)
+
+        # Send response back to the channel (with AI)
+        send_message_to_channel(event['channel'], result, file_name, include_ai=True)
 
 @app.route('/slack/events', methods=['POST'])
 def slack_events():
     """
     Handle Slack events (like file uploads)
     """
-    global LAST_UPLOADED_FILE, LAST_UPLOADED_FILE_NAME, LAST_ANALYSIS_RESULT
-    
     data = request.json
-    
+
     # Handle URL verification challenge (first time setup)
     if 'challenge' in data:
-        print("✅ Received Slack verification challenge")
+        log.info("✅ Received Slack verification challenge")
         return jsonify({'challenge': data['challenge']})
-    
+
     # Ignore retry attempts (Slack sends these if we're slow)
     if request.headers.get('X-Slack-Retry-Num'):
-        print("⚠️ Ignoring retry request")
+        log.warning("⚠️ Ignoring retry request")
         return jsonify({'status': 'ok'})
-    
+
     # Handle actual events
     event = data.get('event', {})
     event_type = event.get('type')
-    
-    print(f"📨 Received event: {event_type}")
-    
+
+    log.info(f"📨 Received event: {event_type}")
+
     # Check if it's a file share event
     if event_type == 'message' and 'files' in event:
-        # Get the first uploaded file
-        file_info = event['files'][0]
-        file_url = file_info.get('url_private')
-        file_name = file_info.get('name', 'unknown')
-        
-        print(f"📎 File uploaded: {file_name}")
-        
-        # Check if it's an Excel file
-        if file_name.endswith(('.xlsx', '.xls')):
-            # Save as the last uploaded file
-            LAST_UPLOADED_FILE = file_url
-            LAST_UPLOADED_FILE_NAME = file_name
-            print(f"💾 Saved as last uploaded file: {file_name}")
-            
-            # Analyze the uploaded file
-            print(f"🔍 Analyzing {file_name}...")
-            result = calculate_loss_ratio(file_url)
-            
-            # Save the analysis for /explain command
-            LAST_ANALYSIS_RESULT = result
-            
-            # Send response back to the channel (with AI)
-            send_message_to_channel(event['channel'], result, file_name, include_ai=True)
-        else:
-            # Not an Excel file
-            print(f"⚠️ File is not Excel: {file_name}")
-            error_result = {
-                'success': False, 
-                'error': f'Please upload an Excel file (.xlsx or .xls). You uploaded: {file_name}'
-            }
-            send_message_to_channel(event['channel'], error_result, include_ai=False)
-    
+        # Run the download/parse/AI/post chain off-request so the 200 ACK
+        # reaches Slack well inside its 3-second window (no retry storms)
+        _event_pool.submit(_handle_file_event, event)
+
     return jsonify({'status': 'ok'})
 
 @app.route('/lossratio', methods=['POST'])
 def lossratio_command():
     """
     Handle the /lossratio slash command from Slack
-    Uses the most recently uploaded file, or falls back to default
+    Uses the channel's most recently uploaded file, or falls back to default
     """
-    global LAST_UPLOADED_FILE, LAST_UPLOADED_FILE_NAME, LAST_ANALYSIS_RESULT
-    
-    print("📊 /lossratio command received")
-    
+    log.info("📊 /lossratio command received")
+
+    channel = request.form.get('channel_id')
+    state = get_state(channel) or {}
+
     # Decide which file to analyze
-    if LAST_UPLOADED_FILE:
-        print(f"📂 Using last uploaded file: {LAST_UPLOADED_FILE_NAME}")
-        result = calculate_loss_ratio(LAST_UPLOADED_FILE)
-        file_name = LAST_UPLOADED_FILE_NAME
+    if state.get('file_url'):
+        file_name = state.get('file_name')
+        log.info(f"📂 Using last uploaded file: {file_name}")
+        result = calculate_loss_ratio(state['file_url'], file_id=state.get('file_id'))
     else:
-        print(f"📂 Using default file: {EXCEL_FILE}")
+        log.info(f"📂 Using default file: {EXCEL_FILE}")
         result = calculate_loss_ratio()
         file_name = None
-    
+
     # Save the analysis for /explain command
-    LAST_ANALYSIS_RESULT = result
+    put_state(channel, result=result)
     
     # Format and return response (with AI)
     response = format_slack_response(result, file_name, include_ai=True)
@@ -322,23 +999,23 @@ def explain_command():
     """
     Handle the /explain slash command - AI-powered Q&A about the analysis
     """
-    global LAST_ANALYSIS_RESULT
-    
-    print("🤖 /explain command received")
-    
+    log.info("🤖 /explain command received")
+
     # Get the user's question and channel info
     question = request.form.get('text', '').strip()
     channel_id = request.form.get('channel_id')
     user_id = request.form.get('user_id')
-    
+
     if not question:
         return jsonify({
             'response_type': 'ephemeral',
             'text': "❓ Please ask a question! Example: `/explain why is the loss ratio high?`"
         })
-    
-    # Check if we have analysis data
-    if not LAST_ANALYSIS_RESULT or not LAST_ANALYSIS_RESULT.get('success'):
+
+    # Check if we have analysis data for this channel
+    state = get_state(channel_id) or {}
+    analysis_result = state.get('result')
+    if not analysis_result or not analysis_result.get('success'):
         return jsonify({
             'response_type': 'ephemeral',
             'text': "⚠️ No analysis data available. Please upload a file or run `/lossratio` first."
@@ -352,27 +1029,11 @@ def explain_command():
     })
     
     # Generate AI answer in background and post to channel
-    import threading
-    
-    def generate_and_post_answer():
-        try:
-            from slack_sdk import WebClient
-            
-            print(f"🤖 Generating answer for: {question}")
-            answer = answer_actuarial_question(question, LAST_ANALYSIS_RESULT)
-            
-            # Post the answer to the channel
-            client = WebClient(token=SLACK_BOT_TOKEN)
-            message = f"🤖 *AI Answer:*\n{answer}"
-            client.chat_postMessage(channel=channel_id, text=message)
-            print(f"✅ Posted AI answer to channel")
-        except Exception as e:
-            print(f"❌ Error posting answer: {e}")
-    
-    # Start background thread
-    thread = threading.Thread(target=generate_and_post_answer)
-    thread.start()
-    
+    asyncio.run_coroutine_threadsafe(
+        _generate_and_post_answer(question, analysis_result, channel_id),
+        _async_loop
+    )
+
     return immediate_response
 
 @app.route('/health', methods=['GET'])